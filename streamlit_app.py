@@ -1,13 +1,37 @@
 import streamlit as st
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 from datetime import datetime
+import logging
 import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
 
 # === CONFIGURATION ===
 BACKEND_URL = "https://agentbackendservice-dfcpcudzeah4b6ae.northeurope-01.azurewebsites.net/api"
 FUNCTION_KEY = os.environ.get("AZURE_FUNCTION_KEY", "")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
+REQUEST_TIMEOUT = 30
+READ_ONLY_ENDPOINTS = ("list_blobs", "read_blob_file")  # POSTs that are safe to retry
+READ_CACHE_TTL = 60  # seconds read-only backend results are reused across reruns
+EMBED_MODEL = "all-MiniLM-L6-v2"
+SEM_CACHE_THRESHOLD = 0.95  # cosine similarity needed to reuse an earlier answer
+SEM_CACHE_MAX_ENTRIES = 200  # per user; oldest entries are dropped first
+SEM_CACHE_TTL = 600  # seconds a cached answer may be reused before it goes stale
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", "memoria.db")
+CHAT_RENDER_WINDOW = 40  # messages drawn per rerun; "Load earlier" adds this many more
+ETAG_STORE_MAX = 256  # validated bodies kept for If-None-Match revalidation
+# POST endpoints confirmed to answer a matching If-None-Match with 304. RFC 9110 says a
+# non-GET request gets 412 instead, so none are enabled until the backend promises 304.
+ETAG_ENDPOINTS = frozenset(filter(None, os.environ.get("ETAG_ENDPOINTS", "").split(",")))
+CATEGORIES = ["TM", "PS", "LO", "GEN", "ID", "PE", "UI", "ML", "SYS"]
+_USER_ID_RE = re.compile(r"^[a-zA-Z0-9._-]{3,64}$")
+validate_user_id = _USER_ID_RE.fullmatch
 
 # Set page config
 st.set_page_config(
@@ -26,15 +50,25 @@ user_id = st.sidebar.text_input(
     value="default_user",
     help="Your unique user identifier"
 )
+if not validate_user_id(user_id):
+    st.sidebar.warning("User IDs are usually 3-64 characters: letters, digits, '.', '_' or '-'")
 
 # Category selector
-categories = ["TM", "PS", "LO", "GEN", "ID", "PE", "UI", "ML", "SYS"]
 selected_category = st.sidebar.selectbox(
     "Knowledge Category",
-    categories,
+    CATEGORIES,
     help="Select knowledge domain"
 )
 
+use_sem_cache = st.sidebar.checkbox(
+    "⚡ Reuse similar answers",
+    value=False,
+    help="Answer near-identical prompts from recent replies without calling the assistant "
+         "(skips any tools it would run, so leave off for commands that change data)"
+)
+
+new_chat = st.sidebar.button("🆕 New chat", help="Start a fresh conversation thread")
+
 # File selector
 st.sidebar.markdown("---")
 st.sidebar.subheader("📁 File Management")
@@ -47,49 +81,369 @@ with col1:
 with col2:
     if st.button("📋 View Tasks"):
         st.session_state.quick_action = "view_tasks"
+refresh_files = st.sidebar.button("🔄 Refresh Files")
 
 # === HELPER FUNCTIONS ===
-def call_backend(endpoint: str, payload: dict) -> dict:
-    """Call Azure backend with user context"""
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Shared HTTP session so backend calls reuse keep-alive connections"""
+    session = requests.Session()
+    # Default: retry only failed connects, so a chat POST that reached the backend is never replayed
+    session.mount("https://", HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, read=0, backoff_factor=0.3)
+    ))
+    # Read-only endpoints are safe to replay, so they also retry transient gateway errors
+    read_adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False
+        )
+    )
+    for endpoint in READ_ONLY_ENDPOINTS:
+        session.mount(f"{BACKEND_URL}/{endpoint}", read_adapter)
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+def _open_backend(endpoint: str, payload: dict, uid: str, stream: bool = False,
+                  extra_headers: dict = None) -> requests.Response:
+    """POST to the backend and return the raw response; raises on transport/HTTP errors"""
     headers = {
-        "X-User-Id": user_id,
-        "Content-Type": "application/json"
+        "X-User-Id": uid,
+        "Content-Type": "application/json",
+        **(extra_headers or {})
     }
+    if stream:
+        headers["Accept"] = "text/event-stream"
+    # Include function key for authentication
+    url = f"{BACKEND_URL}/{endpoint}?code={FUNCTION_KEY}"
+    response = get_http_session().post(
+        url, data=orjson.dumps(payload), headers=headers, stream=stream, timeout=REQUEST_TIMEOUT
+    )
     try:
-        # Include function key for authentication
-        url = f"{BACKEND_URL}/{endpoint}?code={FUNCTION_KEY}"
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
         response.raise_for_status()
-        return response.json()
+    except requests.exceptions.HTTPError:
+        response.close()  # a streamed body would otherwise hold its pooled connection
+        raise
+    return response
+
+def _decode_json(response: requests.Response):
+    """Parse a JSON body with orjson, raising the same error type as Response.json()"""
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos) from e
+
+@st.cache_resource
+def get_etag_store() -> dict:
+    """Last (etag, body) per user/endpoint/payload, shared across sessions"""
+    return {}
+
+@st.cache_resource
+def get_etag_lock() -> threading.Lock:
+    """Serializes access to the shared ETag store"""
+    return threading.Lock()
+
+def _post_backend(endpoint: str, payload: dict, uid: str) -> dict:
+    """POST to the backend and decode the reply; raises instead of reporting to the UI
+
+    For ETAG_ENDPOINTS the last ETag is sent as If-None-Match and a 304
+    reuses the stored body instead of downloading and parsing it again.
+    """
+    if endpoint not in ETAG_ENDPOINTS:
+        return _decode_json(_open_backend(endpoint, payload, uid))
+
+    store, lock = get_etag_store(), get_etag_lock()
+    key = (uid, endpoint, orjson.dumps(payload, option=orjson.OPT_SORT_KEYS))
+    with lock:
+        cached = store.get(key)
+    if cached:
+        try:
+            response = _open_backend(endpoint, payload, uid, extra_headers={"If-None-Match": cached[0]})
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 412:
+                raise
+            # Precondition Failed: forget the validator and retry once without it
+            with lock:
+                store.pop(key, None)
+            cached = None
+            response = _open_backend(endpoint, payload, uid)
+        if cached and response.status_code == 304:
+            return cached[1]
+    else:
+        response = _open_backend(endpoint, payload, uid)
+
+    body = _decode_json(response)
+    etag = response.headers.get("ETag")
+    if etag:
+        with lock:
+            if key not in store and len(store) >= ETAG_STORE_MAX:
+                store.pop(next(iter(store)))  # drop the oldest entry
+            store[key] = (etag, body)
+    return body
+
+def call_backend(endpoint: str, payload: dict) -> dict:
+    """Call Azure backend with user context"""
+    try:
+        return _post_backend(endpoint, payload, user_id)
     except requests.exceptions.RequestException as e:
         st.error(f"Backend error: {e}")
         return {"error": str(e)}
 
-def send_to_llm(messages: list) -> str:
-    """Send messages to LLM via backend proxy"""
+@st.cache_resource(show_spinner=False)
+def get_embedder():
+    """Load the prompt embedder once per process (None if not installed)"""
+    # Deferred so sessions that never use the cache do not pay for importing torch
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:  # semantic response cache is optional
+        return None
+    try:
+        return SentenceTransformer(EMBED_MODEL)
+    except Exception:  # e.g. offline with no cached model; cache None so it is not retried
+        logging.getLogger(__name__).exception("Could not load embedding model %s", EMBED_MODEL)
+        return None
+
+def embed_prompt(prompt: str):
+    """Unit-norm prompt embedding, or None when the semantic cache is off"""
+    embedder = get_embedder() if use_sem_cache else None
+    if embedder is None:
+        return None
+    return embedder.encode(prompt, normalize_embeddings=True).astype(np.float32)
+
+def semantic_lookup(query):
+    """Return the stored reply for the closest recent prompt, if close enough"""
+    cache = st.session_state.sem_cache.get(user_id)
+    if query is None or not cache or not cache["responses"]:
+        return None
+    if cache["embs"].shape[1] != query.shape[0]:  # saved with a different EMBED_MODEL
+        del st.session_state.sem_cache[user_id]
+        return None
+    scores = cache["embs"] @ query
+    scores[cache["times"] < time.time() - SEM_CACHE_TTL] = -np.inf  # expired entries
+    best = int(scores.argmax())
+    if scores[best] > SEM_CACHE_THRESHOLD:
+        return cache["responses"][best]
+    return None
+
+def semantic_store(query, response: str):
+    """Remember a reply under its prompt embedding (kept per user)"""
+    if query is None:
+        return
+    cache = st.session_state.sem_cache.setdefault(user_id, {
+        "embs": np.zeros((0, query.shape[0]), dtype=np.float32),
+        "times": np.zeros(0),
+        "responses": []
+    })
+    cache["embs"] = np.vstack([cache["embs"], query])[-SEM_CACHE_MAX_ENTRIES:]
+    cache["times"] = np.append(cache["times"], time.time())[-SEM_CACHE_MAX_ENTRIES:]
+    cache["responses"] = (cache["responses"] + [response])[-SEM_CACHE_MAX_ENTRIES:]
+
+def iter_sse_events(response: requests.Response):
+    """Yield the data of each SSE event; multi-line data is joined with newlines"""
+    data_lines = []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:  # a blank line ends the event
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+        elif line.startswith("data:"):
+            data = line[5:]
+            data_lines.append(data[1:] if data.startswith(" ") else data)
+    if data_lines:
+        yield "\n".join(data_lines)
+
+def iter_reply_text(response: requests.Response):
+    """Yield reply text from an SSE stream, or the whole reply from a JSON body"""
+    if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+        result = _decode_json(response)
+        if "response" in result:
+            st.session_state.thread_id = result.get("thread_id")
+            yield result["response"]
+        return
+
+    response.encoding = "utf-8"  # SSE is always UTF-8; requests would guess latin-1
+    for data in iter_sse_events(response):
+        if data == "[DONE]":
+            break
+        try:
+            frame = orjson.loads(data)
+        except ValueError:
+            frame = data
+        if isinstance(frame, dict):
+            if frame.get("thread_id"):
+                st.session_state.thread_id = frame["thread_id"]
+            frame = frame.get("delta") or frame.get("response") or ""
+        elif not isinstance(frame, str):
+            frame = data  # bare tokens such as "42" or "true" are text, not JSON
+        if frame:
+            yield frame
+
+def send_to_llm(messages: list, stats: dict):
+    """Stream the LLM reply via backend proxy, filling in stats once done"""
+    start = time.perf_counter()
+    prompt = messages[-1]["content"] if messages else ""
+    stats.update(cache_hit=False, error=False)
+
+    query = embed_prompt(prompt)
+    cached = semantic_lookup(query)
+    if cached is not None:
+        stats.update(cache_hit=True, response_time=time.perf_counter() - start)
+        yield cached
+        return
+
     payload = {
-        "message": messages[-1]["content"] if messages else "",
+        "message": prompt,
         "user_id": user_id,
-        "thread_id": st.session_state.get("thread_id")
+        "thread_id": st.session_state.get("thread_id"),
+        "stream": True
     }
     
-    result = call_backend("tool_call_handler", payload)
+    parts = []
+    try:
+        with _open_backend("tool_call_handler", payload, user_id, stream=True) as response:
+            for text in iter_reply_text(response):
+                parts.append(text)
+                yield text
+    except requests.exceptions.RequestException as e:
+        st.error(f"Backend error: {e}")
+        stats["error"] = True
+    stats["response_time"] = time.perf_counter() - start
     
-    if "response" in result:
-        st.session_state.thread_id = result.get("thread_id")
-        return result["response"]
-    return "Error communicating with assistant"
-
-def get_file_stats():
-    """Get statistics for all user files"""
-    result = call_backend("list_blobs", {"user_id": user_id})
+    if not parts:
+        stats["error"] = True
+        yield "Error communicating with assistant"
+    elif not stats["error"]:
+        semantic_store(query, "".join(parts))
+
+@st.cache_resource
+def get_db() -> sqlite3.Connection:
+    """Process-wide sqlite store for each user's thread and semantic cache"""
+    conn = sqlite3.connect(SESSION_DB_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sess(user TEXT PRIMARY KEY, thread TEXT, emb BLOB, resp BLOB)"
+    )
+    return conn
+
+@st.cache_resource
+def get_db_lock() -> threading.Lock:
+    """Serializes use of the shared sqlite connection across sessions"""
+    return threading.Lock()
+
+def restore_session(uid: str):
+    """Load a user's persisted thread and semantic cache into session state"""
+    try:
+        with get_db_lock():
+            row = get_db().execute(
+                "SELECT thread, emb, resp FROM sess WHERE user = ?", (uid,)
+            ).fetchone()
+    except sqlite3.Error as e:
+        st.warning(f"Session store unavailable: {e}")
+        return
+    if row is None:
+        return
+    thread, emb, resp = row
+    st.session_state.thread_id = thread
+    try:
+        saved = orjson.loads(resp) if resp else {}
+        responses = saved.get("responses", [])
+        if emb and responses:
+            embs = np.frombuffer(emb, dtype=np.float32).reshape(len(responses), -1)
+            times = np.asarray(saved["times"], dtype=np.float64)
+            if times.shape != (len(responses),):
+                raise ValueError("cache timestamps do not match its replies")
+            st.session_state.sem_cache[uid] = {"embs": embs.copy(), "times": times, "responses": responses}
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        logging.getLogger(__name__).warning("Ignoring unreadable semantic cache for %s: %s", uid, e)
+
+def forget_thread(uid: str):
+    """Drop a user's persisted thread so the next turn starts a new one"""
+    try:
+        with get_db_lock(), get_db() as conn:
+            conn.execute("UPDATE sess SET thread = NULL WHERE user = ?", (uid,))
+    except sqlite3.Error as e:
+        st.warning(f"Session store unavailable: {e}")
+
+def persist_session(uid: str):
+    """Save a user's current thread and semantic cache"""
+    cache = st.session_state.sem_cache.get(uid)
+    emb = cache["embs"].tobytes() if cache else None
+    resp = orjson.dumps(
+        {"responses": cache["responses"], "times": cache["times"].tolist()}
+    ) if cache else None
+    try:
+        with get_db_lock(), get_db() as conn:
+            conn.execute(
+                "INSERT INTO sess(user, thread, emb, resp) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user) DO UPDATE SET thread = excluded.thread, "
+                "emb = excluded.emb, resp = excluded.resp",
+                (uid, st.session_state.thread_id, emb, resp)
+            )
+    except sqlite3.Error as e:
+        st.warning(f"Session store unavailable: {e}")
+
+def record_stats(stats: dict):
+    """Keep a turn's stats as the latest and fold it into the running totals"""
+    st.session_state.last_stats = stats
+    accum = st.session_state.stats_accum
+    accum["n"] += 1
+    accum["sum_time"] += stats["response_time"]
+    accum["errors"] += stats["error"]
+    accum["cache_hits"] += stats["cache_hit"]
+
+# Read-only helpers are cached per user; failures raise, so they are never cached
+@st.cache_data(ttl=READ_CACHE_TTL, show_spinner=False)
+def get_file_stats(uid: str) -> list:
+    """Get statistics for all user files (raises on error)"""
+    result = _post_backend("list_blobs", {"user_id": uid}, uid)
     return result.get("blobs", [])
 
-def read_file_content(filename: str):
-    """Read a specific file"""
-    result = call_backend("read_blob_file", {"file_name": filename})
+@st.cache_data(ttl=READ_CACHE_TTL, show_spinner=False)
+def read_file_content(uid: str, filename: str):
+    """Read a specific file (raises on error)"""
+    result = _post_backend("read_blob_file", {"file_name": filename}, uid)
     return result.get("data", [])
 
+# Initialize session state
+if "messages" not in st.session_state:
+    st.session_state.messages = []
+if "thread_id" not in st.session_state:
+    st.session_state.thread_id = None
+if "sem_cache" not in st.session_state:
+    st.session_state.sem_cache = {}
+if "visible_msgs" not in st.session_state:
+    st.session_state.visible_msgs = CHAT_RENDER_WINDOW
+if "last_stats" not in st.session_state:
+    st.session_state.last_stats = None
+if "stats_accum" not in st.session_state:
+    # Running totals over every turn, so no per-turn history needs to be kept
+    st.session_state.stats_accum = {"sum_time": 0.0, "errors": 0, "cache_hits": 0, "n": 0}
+
+# Threads are per user, so pick up this user's saved thread on first use or after a switch
+if st.session_state.get("restored_user") != user_id:
+    # The transcript belongs to the previous user's thread, so it goes with it
+    st.session_state.thread_id = None
+    st.session_state.messages = []
+    st.session_state.visible_msgs = CHAT_RENDER_WINDOW
+    restore_session(user_id)
+    st.session_state.restored_user = user_id
+
+if new_chat:
+    st.session_state.thread_id = None
+    st.session_state.messages = []
+    st.session_state.visible_msgs = CHAT_RENDER_WINDOW
+    forget_thread(user_id)
+
+if refresh_files:
+    get_file_stats.clear(user_id)
+    read_file_content.clear()
+
 # === MAIN LAYOUT ===
 # Main content area with two columns
 main_col1, main_col2 = st.columns([3, 1])
@@ -101,16 +455,22 @@ with main_col1:
     # Chat interface
     st.subheader("💬 Chat")
     
-    # Initialize session state
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    if "thread_id" not in st.session_state:
-        st.session_state.thread_id = None
+    # Messages live in a container above the input so new turns render in order
+    chat_box = st.container()
     
-    # Display chat history
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.write(message["content"])
+    # Display chat history (only the most recent window; the backend thread keeps context)
+    with chat_box:
+        if st.session_state.thread_id and not st.session_state.messages:
+            st.caption("Continuing your previous conversation. Use 🆕 New chat to start over.")
+        if len(st.session_state.messages) > st.session_state.visible_msgs:
+            if st.button("⬆️ Load earlier", key="load_earlier"):
+                st.session_state.visible_msgs += CHAT_RENDER_WINDOW
+            hidden = len(st.session_state.messages) - st.session_state.visible_msgs
+            if hidden > 0:
+                st.caption(f"{hidden} earlier messages not shown")
+        for message in st.session_state.messages[-st.session_state.visible_msgs:]:
+            with st.chat_message(message["role"]):
+                st.write(message["content"])
     
     # Chat input with unique key
     prompt = st.chat_input("Ask me anything...", key="chat_input_unique")
@@ -118,25 +478,34 @@ with main_col1:
     if prompt:
         # Add user message
         st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.write(prompt)
-        
-        # Get LLM response
-        with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                response = send_to_llm(st.session_state.messages)
-            st.write(response)
+        with chat_box:
+            with st.chat_message("user"):
+                st.write(prompt)
+            
+            # Get LLM response
+            with st.chat_message("assistant"):
+                stats = {}
+                response = st.write_stream(send_to_llm(st.session_state.messages, stats))
         
         # Store assistant response
         st.session_state.messages.append({"role": "assistant", "content": response})
-        st.rerun()
+        record_stats(stats)
+        if not stats["error"] and not stats["cache_hit"]:
+            persist_session(user_id)
+        if not stats["cache_hit"]:
+            # The assistant's tools may have written files, so refetch the listing
+            get_file_stats.clear(user_id)
 
 with main_col2:
     st.subheader("📊 Context")
     
     # File stats
     st.markdown("**📁 Your Files:**")
-    files = get_file_stats()
+    try:
+        files = get_file_stats(user_id)
+    except requests.exceptions.RequestException as e:
+        st.error(f"Backend error: {e}")
+        files = []
     
     if files:
         for file in files[:5]:  # Show top 5
@@ -149,6 +518,14 @@ with main_col2:
     st.markdown("**✅ Quick Stats:**")
     st.metric("Total Files", len(files))
     st.metric("Category", selected_category)
+    last_stats = st.session_state.last_stats
+    if last_stats:
+        st.metric("Last Response", f"{last_stats['response_time']:.2f}s")
+        if last_stats["cache_hit"]:
+            st.caption("⚡ Answered from cache")
+        accum = st.session_state.stats_accum
+        st.metric("Avg Response", f"{accum['sum_time'] / accum['n']:.2f}s")
+        st.caption(f"Turns: {accum['n']} | Errors: {accum['errors']} | Cached: {accum['cache_hits']}")
     
     # User info
     st.markdown("---")